@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 # coding=utf-8
-import serial, time, argparse
-from prometheus_client import start_http_server, Gauge
+import serial, time, argparse, struct, sys, os, select, signal, statistics
+from array import array
 import threading
 
 # Command definitions for the SDS011 sensor
@@ -14,30 +14,67 @@ CMD_WORKING_PERIOD = 8
 MODE_ACTIVE = 0
 MODE_QUERY = 1
 PERIOD_CONTINUOUS = 0
+READ_TIMEOUT = 3.0  # Seconds to wait for a frame; well above the 1s active-mode push interval
+WARMUP_SECONDS = 30  # Fan and laser need this long after waking before readings are stable
 
-# Create Prometheus metrics
-PM25_GAUGE = Gauge('sds011_pm25', 'PM2.5 particulate matter in μg/m³')
-PM10_GAUGE = Gauge('sds011_pm10', 'PM10 particulate matter in μg/m³')
+# Output formats for the per-reading and per-cycle lines
+READING_FMT = "PM2.5: %.1f μg/m³, PM10: %.1f μg/m³\n"
+MEDIAN_FMT = "MEDIAN: PM2.5: %.1f μg/m³, PM10: %.1f μg/m³ (from %d readings)\n"
+
+# Set by the SIGTERM handler to stop the main loop
+_stop = threading.Event()
+
+# PM2.5 and PM10 are little-endian uint16 values at bytes 2-5 of a data frame
+_PM_STRUCT = struct.Struct('<HH')
+
+# Receive buffer reused for every frame; read_response returns it, so callers must consume it before the next read
+_RX = bytearray(10)
+_RX_MV = memoryview(_RX)
+
+# Prometheus metrics, created on first use so prometheus_client is only imported with --prometheus
+PM25_GAUGE = None
+PM10_GAUGE = None
+GAUGE_EPSILON = 0.05  # Skip gauge updates smaller than this (μg/m³)
+_last_pm25 = None
+_last_pm10 = None
 
 def dump(d, prefix=''):
     """Print byte data in hex format for debugging"""
     print(prefix + ' '.join('{:02x}'.format(b) for b in d))
 
-def construct_command(cmd, data=[], debug=False):
+def construct_command(cmd, data=(), debug=False):
     """Construct a command packet to send to the SDS011 sensor"""
     assert len(data) <= 12
-    data += [0,]*(12-len(data))  # Pad with zeros to 12 bytes
-    checksum = (sum(data)+cmd-2)%256  # Calculate checksum per sensor protocol
     
-    # Build the command packet: header + command + data + ID + checksum + tail
-    ret = bytearray([0xaa, 0xb4, cmd])
-    ret.extend(data)
-    ret.extend([0xff, 0xff, checksum, 0xab])
+    # Build the command packet: header + command + data (zero-padded to 12 bytes) + ID + checksum + tail
+    buf = bytearray(19)
+    buf[0] = 0xaa
+    buf[1] = 0xb4
+    buf[2] = cmd
+    buf[3:3 + len(data)] = bytes(data)
+    buf[15] = 0xff
+    buf[16] = 0xff
+    buf[17] = (sum(buf[3:15]) + cmd - 2) & 0xFF  # Checksum per sensor protocol (the 0xFF 0xFF ID adds -2 mod 256)
+    buf[18] = 0xab
+    ret = bytes(buf)
 
     if debug:
         dump(ret, '> ')
     return ret
 
+# Precomputed packets for the commands sent during normal operation
+SLEEP_PKT = construct_command(CMD_SLEEP, [0x1, 0])
+WAKE_PKT = construct_command(CMD_SLEEP, [0x1, 1])
+MODE_ACTIVE_PKT = construct_command(CMD_MODE, [0x1, MODE_ACTIVE])
+PERIOD_CONT_PKT = construct_command(CMD_WORKING_PERIOD, [0x1, PERIOD_CONTINUOUS])
+
+CMDS = {
+    'sleep': SLEEP_PKT,
+    'wake': WAKE_PKT,
+    'mode_active': MODE_ACTIVE_PKT,
+    'period_cont': PERIOD_CONT_PKT,
+}
+
 def process_data(d, debug=False, verbose=True):
     """Process the data returned from the sensor"""
     if len(d) < 10:
@@ -46,91 +83,166 @@ def process_data(d, debug=False, verbose=True):
             dump(d, 'Data: ')
         return None
         
-    try:
-        # Extract PM2.5 and PM10 values according to the SDS011 protocol
-        pm25_low = d[2]
-        pm25_high = d[3]
-        pm10_low = d[4]
-        pm10_high = d[5]
-        
-        # Calculate real values: data is sent in 0.1 μg/m³ units
-        pm25 = (pm25_high * 256 + pm25_low) / 10.0
-        pm10 = (pm10_high * 256 + pm10_low) / 10.0
-        
-        if debug:
-            print(f"PM2.5: {pm25_low},{pm25_high} -> {pm25:.1f} μg/m³")
-            print(f"PM10: {pm10_low},{pm10_high} -> {pm10:.1f} μg/m³")
-        
-        return [pm25, pm10]
-    except Exception as e:
+    # Reject corrupt frames: checksum is the low byte of the sum of data bytes 2-7
+    if (sum(d[2:8]) & 0xFF) != d[8] or d[9] != 0xab:
         if verbose:
-            print(f"Error processing data: {e}")
-            dump(d, 'Raw data: ')
+            print("Warning: Invalid checksum or tail in sensor data")
+            dump(d, 'Data: ')
         return None
+    
+    # Extract PM2.5 and PM10 values according to the SDS011 protocol (little-endian)
+    pm25_raw, pm10_raw = _PM_STRUCT.unpack_from(d, 2)
+    
+    # Calculate real values: data is sent in 0.1 μg/m³ units
+    pm25 = pm25_raw / 10.0
+    pm10 = pm10_raw / 10.0
+    
+    if debug:
+        print(f"PM2.5: {pm25_raw} -> {pm25:.1f} μg/m³")
+        print(f"PM10: {pm10_raw} -> {pm10:.1f} μg/m³")
+    
+    return [pm25, pm10]
+
+def wait_for_bytes(count, timeout=READ_TIMEOUT):
+    """Wait until at least count bytes are queued on the port, return how many are available"""
+    fd = ser.fileno()
+    deadline = time.monotonic() + timeout
+    while True:
+        available = ser.in_waiting  # FIONREAD
+        remaining = deadline - time.monotonic()
+        if available >= count or remaining <= 0:
+            return available
+        if available == 0:
+            select.select([fd], [], [], remaining)  # Sleep until the first byte arrives
+        else:
+            # Part of a frame is in: sleep for the time the rest takes on the wire (10 bits per byte)
+            time.sleep(min(remaining, (count - available) * 10.0 / ser.baudrate))
 
 def read_response(debug=False, verbose=True):
     """Read and validate the response from the sensor"""
     try:
-        # Look for the start byte (0xAA)
-        byte = 0
-        attempts = 0
-        max_attempts = 100
-        
-        while byte != 0xaa and attempts < max_attempts:
-            byte_str = ser.read(size=1)
-            if not byte_str:
-                if verbose:
-                    print("No data received from sensor")
-                time.sleep(0.1)
-                attempts += 1
-                continue
-                
-            byte = byte_str[0]
-            attempts += 1
+        # The input buffer is flushed every cycle, so once 10 bytes are queued a single read gets the frame
+        n = os.readv(ser.fileno(), [_RX]) if wait_for_bytes(10) else 0
+        if n == 0:
+            if verbose:
+                print("No data received from sensor")
+            return bytearray()
+
+        if _RX[0] != 0xaa:
+            # Misaligned: drop bytes before the next start byte (0xAA) and read the rest of that frame
+            start = _RX.find(b'\xaa', 0, n)
+            if start < 0:
+                header = ser.read_until(b'\xaa', size=64)
+                if not header or header[-1] != 0xaa:
+                    if verbose:
+                        print("No start byte received from sensor")
+                    return bytearray()
+                _RX[0] = 0xaa
+                n = 1
+            else:
+                _RX[:n - start] = _RX[start:n]
+                n -= start
 
-        if attempts >= max_attempts:
+        if n < 10:
+            # Short read: fetch the rest of the frame so its tail doesn't misalign the next read
+            n += ser.readinto(_RX_MV[n:])
+
+        if n != 10:
             if verbose:
-                print("Failed to get proper response after max attempts")
+                print(f"Warning: Incomplete response, got {n} of 10 bytes")
             return bytearray()
-            
-        # Read the rest of the response (9 more bytes)
-        d = ser.read(size=9)
+
         if debug:
-            full_response = bytearray([byte]) + d
-            dump(full_response, '< ')
-        return bytearray([byte]) + d
+            dump(_RX, '< ')
+        return _RX
     except Exception as e:
         if verbose:
             print(f"Exception in read_response: {e}")
         return bytearray()
 
-def cmd_set_mode(mode=MODE_QUERY, debug=False, verbose=True):
-    """Set the reporting mode of the sensor"""
-    ser.write(construct_command(CMD_MODE, [0x1, mode], debug))
-    read_response(debug, verbose)
+def _send(name, debug=False, verbose=True):
+    """Send one of the commands in CMDS and return the sensor's reply"""
+    pkt = CMDS[name]
+    if debug:
+        dump(pkt, '> ')
+    ser.write(pkt)
+    return read_response(debug, verbose)
+
+def _is_reply(d, name):
+    """Check that d is the sensor's reply (0xC5) to the command name from CMDS"""
+    return len(d) >= 10 and d[1] == 0xc5 and d[2] == CMDS[name][2]
+
+def _send_batch(names, debug=False, verbose=True, timeout=READ_TIMEOUT):
+    """Send several commands from CMDS in one write, then return the names that got no reply"""
+    pkts = b''.join(CMDS[name] for name in names)
+    if debug:
+        dump(pkts, '> ')
+    ser.write(pkts)
 
-def cmd_query_data(debug=False, verbose=True):
-    """Request a new measurement from the sensor"""
-    ser.write(construct_command(CMD_QUERY_DATA, debug=debug))
+    # The sensor may already be pushing 0xC0 data frames, so collect 0xC5 replies until all match or time runs out
+    missing = list(names)
+    deadline = time.monotonic() + timeout
+    while missing and time.monotonic() < deadline:
+        d = read_response(debug, verbose)
+        for name in missing:
+            if _is_reply(d, name):
+                missing.remove(name)
+                break
+    return missing
+
+def read_data(debug=False, verbose=True):
+    """Wait for the next measurement pushed by the sensor in active mode"""
     d = read_response(debug, verbose)
     values = None
-    if len(d) >= 10 and d[1] == 0xc0:  # Valid response has 0xC0 as command byte
+    if len(d) >= 10 and d[1] == 0xc0:  # Skip command replies, only 0xC0 frames carry data
         values = process_data(d, debug, verbose)
     return values
 
-def cmd_set_sleep(sleep, debug=False, verbose=True):
-    """Set the sensor to sleep mode or wake it up"""
-    mode = 0 if sleep else 1  # 0 = sleep, 1 = wake
-    ser.write(construct_command(CMD_SLEEP, [0x1, mode], debug))
-    read_response(debug, verbose)
+def set_low_latency(ser, verbose=True):
+    """Enable ASYNC_LOW_LATENCY on the serial port (drops FTDI latency from 16ms to 1ms)"""
+    try:
+        ser.set_low_latency_mode(True)  # TIOCGSERIAL/TIOCSSERIAL under the hood
+    except (AttributeError, ValueError) as e:
+        # Not Linux, or the adapter does not support the serial_struct ioctls
+        if verbose:
+            print(f"Could not enable low latency mode: {e}")
+
+def get_gauges():
+    """Create the Prometheus gauges on first use and return them"""
+    global PM25_GAUGE, PM10_GAUGE
+    if PM25_GAUGE is None:
+        from prometheus_client import Gauge
+        PM25_GAUGE = Gauge('sds011_pm25', 'PM2.5 particulate matter in μg/m³')
+        PM10_GAUGE = Gauge('sds011_pm10', 'PM10 particulate matter in μg/m³')
+    return PM25_GAUGE, PM10_GAUGE
+
+def update_metrics(pm25, pm10):
+    """Publish the cycle medians, skipping gauges whose value has not changed"""
+    global _last_pm25, _last_pm10
+    pm25_gauge, pm10_gauge = get_gauges()
+    if _last_pm25 is None or abs(pm25 - _last_pm25) > GAUGE_EPSILON:
+        pm25_gauge.set(pm25)
+        _last_pm25 = pm25
+    if _last_pm10 is None or abs(pm10 - _last_pm10) > GAUGE_EPSILON:
+        pm10_gauge.set(pm10)
+        _last_pm10 = pm10
+
+def sleep_until(deadline):
+    """Sleep until the monotonic deadline in steps of at most 1s, returning early if a stop was requested"""
+    while not _stop.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(1.0, remaining))
 
-def cmd_set_working_period(period, debug=False, verbose=True):
-    """Set the working period of the sensor"""
-    ser.write(construct_command(CMD_WORKING_PERIOD, [0x1, period], debug))
-    read_response(debug, verbose)
+def handle_sigterm(signum, frame):
+    """Ask the main loop to stop (systemd sends SIGTERM on service stop)"""
+    _stop.set()
 
 def start_prometheus_server(port=8000):
     """Start the Prometheus metrics HTTP server"""
+    from prometheus_client import start_http_server
+    get_gauges()  # Register the metrics before the first scrape
     start_http_server(port)
     print(f"Prometheus metrics server started on port {port}")
 
@@ -139,10 +251,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='SDS011 Air Quality Monitor')
     parser.add_argument('--no-sleep', action='store_true', help='Disable sleep mode (continuous measurements)')
     parser.add_argument('--debug', action='store_true', help='Enable debug output')
-    parser.add_argument('--quiet', action='store_true', help='Reduce verbosity (only print averages)')
+    parser.add_argument('--quiet', action='store_true', help='Reduce verbosity (only print the per-cycle medians)')
     parser.add_argument('--port', type=int, default=8000, help='Prometheus metrics server port')
     parser.add_argument('--prometheus', action='store_true', help='Enable Prometheus metrics publishing')
+    parser.add_argument('--readings', type=int, default=5, help='Readings per cycle (1/s); the reported value is their median, so single-sample spikes are ignored')
     args = parser.parse_args()
+    if args.readings < 1:
+        parser.error("--readings must be at least 1")
     
     # Set variables from arguments
     DEBUG = args.debug
@@ -150,6 +265,14 @@ if __name__ == "__main__":
     SLEEP_ENABLED = not args.no_sleep
     PROMETHEUS_ENABLED = args.prometheus
     
+    # Hot-path logger: formatting only happens when verbose output is enabled
+    if VERBOSE:
+        log = lambda fmt, *a: sys.stdout.write(fmt % a)
+    else:
+        log = lambda fmt, *a: None
+    
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
     # Start Prometheus metrics server if enabled
     if PROMETHEUS_ENABLED:
         start_prometheus_server(args.port)
@@ -160,8 +283,10 @@ if __name__ == "__main__":
     ser = serial.Serial()
     ser.port = "/dev/ttyUSB0"
     ser.baudrate = 9600
+    ser.timeout = READ_TIMEOUT  # Blocking reads return as soon as data arrives, or after READ_TIMEOUT
     
     ser.open()
+    set_low_latency(ser, VERBOSE)
     ser.flushInput()
     
     if VERBOSE:
@@ -177,62 +302,82 @@ if __name__ == "__main__":
     
     try:
         # Initialize the sensor
-        cmd_set_sleep(0, DEBUG, VERBOSE)  # Wake up the sensor
-        cmd_set_working_period(PERIOD_CONTINUOUS, DEBUG, VERBOSE)  # Set to continuous measurement
-        cmd_set_mode(MODE_QUERY, DEBUG, VERBOSE)  # Set to query mode
+        # Wake up, set continuous measurement and have the sensor push a reading every second
+        for name in _send_batch(['wake', 'period_cont', 'mode_active'], DEBUG, VERBOSE):
+            # A command can be dropped while the sensor is still waking up, so retry it on its own
+            if _send_batch([name], DEBUG, VERBOSE):
+                print(f"Warning: sensor did not acknowledge the '{name}' command")
+        
+        # Take multiple readings and report the median, which ignores single-sample spikes
+        readings_per_cycle = args.readings
+        # Preallocated buffers for the readings of the current cycle
+        pm25_buf = array('d', [0.0] * readings_per_cycle)
+        pm10_buf = array('d', [0.0] * readings_per_cycle)
         
         if VERBOSE:
             print("Starting main loop...")
         
-        while True:
-            cmd_set_sleep(0, DEBUG, VERBOSE)  # Ensure the sensor is awake
+        # In sleep mode a cycle is warm-up, readings at 1/s, then 1 min asleep; anchored to the cycle start so it doesn't drift
+        cycle_seconds = WARMUP_SECONDS + readings_per_cycle + 60
+        
+        warm_up = True  # The sensor was just woken during setup
+        while not _stop.is_set():
+            cycle_start = time.monotonic()
+            _send('wake', DEBUG, VERBOSE)  # Ensure the sensor is awake
+            if warm_up:
+                if VERBOSE:
+                    print(f"Warming up sensor for {WARMUP_SECONDS}s...")
+                sleep_until(time.monotonic() + WARMUP_SECONDS)
+                warm_up = False
+            ser.reset_input_buffer()  # Drop stale and warm-up frames so each read starts on a fresh frame
             valid_readings = 0
-            pm25_sum = 0
-            pm10_sum = 0
-            
-            # Take multiple readings to create a stable average
-            readings_per_cycle = 15
             
             for t in range(readings_per_cycle):
-                values = cmd_query_data(DEBUG, VERBOSE)
+                if _stop.is_set():
+                    break
+                values = read_data(DEBUG, VERBOSE)  # Blocks until the next frame arrives
                 if values is not None and len(values) == 2:
-                    if VERBOSE:
-                        print(f"PM2.5: {values[0]:.1f} μg/m³, PM10: {values[1]:.1f} μg/m³")
+                    log(READING_FMT, values[0], values[1])
+                    pm25_buf[valid_readings] = values[0]
+                    pm10_buf[valid_readings] = values[1]
                     valid_readings += 1
-                    pm25_sum += values[0]
-                    pm10_sum += values[1]
                 else:
-                    if VERBOSE:
-                        print("Invalid reading received")
-                time.sleep(2)  # Wait between readings
+                    log("Invalid reading received\n")
             
-            # Calculate and report averages
+            if _stop.is_set():
+                break  # Don't report a partial cycle while shutting down
+            
+            # Calculate and report the median of the cycle's readings
             if valid_readings > 0:
-                pm25_avg = pm25_sum / valid_readings
-                pm10_avg = pm10_sum / valid_readings
+                pm25_median = statistics.median(pm25_buf[:valid_readings])
+                pm10_median = statistics.median(pm10_buf[:valid_readings])
                 
                 # Update Prometheus metrics if enabled
                 if PROMETHEUS_ENABLED:
-                    PM25_GAUGE.set(pm25_avg)
-                    PM10_GAUGE.set(pm10_avg)
+                    update_metrics(pm25_median, pm10_median)
                 
-                # Always print averages, even in quiet mode
-                print(f"AVERAGE: PM2.5: {pm25_avg:.1f} μg/m³, PM10: {pm10_avg:.1f} μg/m³ (from {valid_readings} readings)")
+                # Always print medians, even in quiet mode
+                sys.stdout.write(MEDIAN_FMT % (pm25_median, pm10_median, valid_readings))
                 
                 # Handle sleep mode based on flag
                 if SLEEP_ENABLED:
+                    wake_at = cycle_start + cycle_seconds
                     if VERBOSE:
-                        print("Going to sleep for 1 min...")
-                    cmd_set_sleep(1, DEBUG, VERBOSE)  # Put sensor to sleep
-                    time.sleep(60)  # Sleep for 1 minute
+                        print(f"Going to sleep for {max(0.0, wake_at - time.monotonic()):.0f}s...")
+                    _send('sleep', DEBUG, VERBOSE)  # Put sensor to sleep
+                    warm_up = True  # Needs warming up again after waking
+                    sleep_until(wake_at)  # Sleep until the next cycle starts
                 else:
                     if VERBOSE:
                         print("Continuing measurements (sleep disabled)...")
-                    time.sleep(2)  # Just pause briefly before the next cycle
+                    sleep_until(time.monotonic() + 2)  # Just pause briefly before the next cycle
             else:
                 if VERBOSE:
                     print("No valid readings in this cycle, retrying...")
-                time.sleep(5)  # Short retry delay
+                sleep_until(time.monotonic() + 5)  # Short retry delay
+        
+        if VERBOSE:
+            print("Program stopped by SIGTERM")
                 
     except KeyboardInterrupt:
         if VERBOSE:
@@ -244,6 +389,12 @@ if __name__ == "__main__":
             traceback.print_exc()
     finally:
         # Clean up before exit
+        try:
+            _send('sleep', DEBUG, VERBOSE)  # Turn off the laser and fan before exiting
+        except Exception as e:
+            # Don't let a serial error here hide the exception that got us here
+            if VERBOSE:
+                print(f"Could not put sensor to sleep: {e}")
         if VERBOSE:
             print("Closing serial port")
         ser.close()